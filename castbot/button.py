@@ -43,7 +43,7 @@ class VideoControlButton(Button):
         self.playing_video = playing_video
 
     def get_data(self):
-        return gen_data(self.PREFIX, self.playing_video.local_token, self.text)
+        return self.playing_video.data_prefix(self.PREFIX) + self.text
 
     @classmethod
     async def from_data(cls, data, playing_videos, user_id, message, finders):
@@ -81,7 +81,7 @@ class DeviceMenuButton(Button):
         self.finders = finders
 
     def get_data(self):
-        return gen_data(self.PREFIX, self.playing_video.local_token, self.text)
+        return self.playing_video.data_prefix(self.PREFIX) + self.text
 
     @classmethod
     async def from_data(cls, data, playing_videos, user_id, message, finders):
@@ -110,7 +110,7 @@ class DeviceSelectButton(Button):
         self.finders = finders
 
     def get_data(self):
-        return gen_data(self.PREFIX, self.playing_video.local_token, self.text)
+        return self.playing_video.data_prefix(self.PREFIX) + self.text
 
     @classmethod
     async def from_data(cls, data, playing_videos, user_id, message, finders):
@@ -30,8 +30,13 @@ class RequestHandler(abc.ABC):
 
 RoutersDefType = typing.List[RequestHandler]
 
+CAP_PAUSE = 1
+CAP_RESUME = 2
+
 
 class Device(abc.ABC):
+    capabilities: int = 0
+
     @abc.abstractmethod
     async def stop(self):
         raise NotImplementedError
@@ -125,6 +130,8 @@ class DeviceFinderCollection:
 
 
 __all__ = [
+    "CAP_PAUSE",
+    "CAP_RESUME",
     "Device",
     "DeviceFinder",
     "DeviceFinderCollection",
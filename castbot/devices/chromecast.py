@@ -6,7 +6,7 @@ import typing
 import catt.api
 
 from ..utils import LocalToken
-from ..device import Device, DeviceFinder
+from ..device import CAP_PAUSE, CAP_RESUME, Device, DeviceFinder
 
 __all__ = ["Finder"]
 
@@ -19,6 +19,7 @@ async def run_method_in_executor(func, *args, **kwargs):
 
 
 class ChromecastDevice(Device):
+    capabilities = CAP_PAUSE | CAP_RESUME
     _device: catt.api.CattDevice
 
     def __init__(self, device: catt.api.CattDevice):
@@ -19,7 +19,7 @@ from async_upnp_client.exceptions import UpnpError
 from async_upnp_client.search import async_search
 
 from ..utils import LocalToken
-from ..device import Device, DeviceFinder, RoutersDefType, RequestHandler
+from ..device import CAP_PAUSE, CAP_RESUME, Device, DeviceFinder, RoutersDefType, RequestHandler
 
 __all__ = ["Finder"]
 
@@ -213,6 +213,7 @@ class SubscribeTask:
 
 
 class UpnpDevice(Device):
+    capabilities = CAP_PAUSE | CAP_RESUME
     _device: UpnpServiceDevice
     _service: UpnpService
     _subscribe_task: typing.Optional[SubscribeTask]
@@ -1,7 +1,10 @@
 import asyncio
+import collections
+import functools
 import logging
 import os.path
 import re
+import socket
 import typing
 from urllib.parse import quote
 
@@ -17,6 +20,20 @@ __all__ = ["Http"]
 
 _RANGE_REGEX = re.compile(r"bytes=([0-9]+)-([0-9]+)?")
 
+_FILENAME_HEADER_CACHE_SIZE = 256
+_STREAM_SNDBUF_SIZE = 4 * 1048576
+
+_ACCESS_CONTROL_HEADERS = {
+    "Content-Type": "video/mp4",
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type",
+    "transferMode.dlna.org": "Streaming",
+    "TimeSeekRange.dlna.org": "npt=0.00-",
+    # This line is causing Samsung TV to fail
+    # "contentFeatures.dlna.org": "DLNA.ORG_OP=01;DLNA.ORG_CI=0;",
+}
+
 
 def mtproto_filename(message: Message) -> str:
     if not (isinstance(message.media, MessageMediaDocument) and isinstance(message.media.document, Document)):
@@ -31,14 +48,14 @@ def mtproto_filename(message: Message) -> str:
 
 
 async def _debounce_wrap(
-    function: typing.Callable[..., typing.Coroutine], args: typing.Tuple[typing.Any, ...], timeout: int
+    function: typing.Callable[..., typing.Coroutine], args: typing.Tuple[typing.Any, ...], timeout: float
 ):
     await asyncio.sleep(timeout)
     await function(*args)
 
 
 class AsyncDebounce:
-    def __init__(self, function: typing.Callable[..., typing.Coroutine], timeout: int):
+    def __init__(self, function: typing.Callable[..., typing.Coroutine], timeout: float):
         self._function = function
         self._timeout = timeout
         self._task: typing.Optional[asyncio.Task] = None
@@ -99,9 +116,11 @@ class Http:
         self._extra_routes = list(extra_routes)
 
         self._tokens: typing.Dict[LocalToken, typing.Any] = {}
-        self._downloaded_blocks: typing.Dict[LocalToken, typing.Set[int]] = {}
+        self._downloaded_blocks: typing.Dict[LocalToken, bytearray] = {}
         self._stream_debounce: typing.Dict[LocalToken, AsyncDebounce] = {}
         self._stream_transports: typing.Dict[LocalToken, typing.Set[asyncio.Transport]] = {}
+        # message_id -> quoted Content-Disposition value, bounded LRU shared by all range requests of a stream
+        self._filename_header_cache: typing.OrderedDict[int, str] = collections.OrderedDict()
         self._bot_client = bot_client
 
     async def start(self):
@@ -145,19 +164,44 @@ class Http:
 
     @staticmethod
     def _write_access_control_headers(result: StreamResponse):
-        result.headers.setdefault("Content-Type", "video/mp4")
-        result.headers.setdefault("Access-Control-Allow-Origin", "*")
-        result.headers.setdefault("Access-Control-Allow-Methods", "GET, OPTIONS")
-        result.headers.setdefault("Access-Control-Allow-Headers", "Content-Type")
-        result.headers.setdefault("transferMode.dlna.org", "Streaming")
-        result.headers.setdefault("TimeSeekRange.dlna.org", "npt=0.00-")
+        headers = result.headers
+        for name, value in _ACCESS_CONTROL_HEADERS.items():
+            headers.setdefault(name, value)
+
+    def _get_filename_header(self, message_id: int) -> typing.Optional[str]:
+        filename_header = self._filename_header_cache.get(message_id)
+
+        if filename_header is not None:
+            self._filename_header_cache.move_to_end(message_id)
+
+        return filename_header
 
-        # This line is causing Samsung TV to fail
-        # result.headers.setdefault("contentFeatures.dlna.org", "DLNA.ORG_OP=01;DLNA.ORG_CI=0;")
+    def _set_filename_header(self, message_id: int, filename_header: str):
+        self._filename_header_cache[message_id] = filename_header
+        self._filename_header_cache.move_to_end(message_id)
+
+        if len(self._filename_header_cache) > _FILENAME_HEADER_CACHE_SIZE:
+            self._filename_header_cache.popitem(last=False)
+
+    @staticmethod
+    def _write_filename_header(result: StreamResponse, filename_header: str):
+        result.headers.setdefault("Content-Disposition", filename_header)
 
     @staticmethod
-    def _write_filename_header(result: StreamResponse, filename: str):
-        result.headers.setdefault("Content-Disposition", f'inline; filename="{quote(filename)}"')
+    def _set_stream_socket_options(transport: typing.Optional[asyncio.Transport], cork: bool):
+        sock = transport.get_extra_info("socket") if transport is not None else None
+
+        if sock is None:
+            return
+
+        try:
+            if cork:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, _STREAM_SNDBUF_SIZE)
+
+            if hasattr(socket, "TCP_CORK"):  # linux only
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(cork))
+        except OSError:
+            logging.debug("Failed to set stream socket options", exc_info=True)
 
     async def _health_check_handler(self, _: Request) -> typing.Optional[Response]:
         try:
@@ -172,16 +216,23 @@ class Http:
         return result
 
     def _feed_timeout(self, local_token: LocalToken, size: int):
-        debounce = self._stream_debounce.setdefault(
-            local_token,
-            AsyncDebounce(self._timeout_handler, self._request_gone_timeout),
-        )
+        debounce = self._stream_debounce.get(local_token)
+
+        if debounce is None:
+            debounce = self._stream_debounce[local_token] = AsyncDebounce(
+                self._timeout_handler, self._request_gone_timeout
+            )
 
         debounce.update_args(local_token, size)
 
-    def _feed_downloaded_blocks(self, block_id: int, local_token: LocalToken):
-        downloaded_blocks = self._downloaded_blocks.setdefault(local_token, set())
-        downloaded_blocks.add(block_id)
+    def _feed_downloaded_blocks(self, block_id: int, local_token: LocalToken, size: int):
+        downloaded_blocks = self._downloaded_blocks.get(local_token)
+        if downloaded_blocks is None:
+            blocks = (size // self._block_size) + 1
+            downloaded_blocks = self._downloaded_blocks[local_token] = bytearray((blocks + 7) >> 3)
+
+        block_index = block_id // self._block_size
+        downloaded_blocks[block_index >> 3] |= 1 << (block_index & 7)
 
     def _feed_stream_transport(self, local_token: LocalToken, transport: asyncio.Transport):
         transports = self._stream_transports.setdefault(local_token, set())
@@ -197,7 +248,8 @@ class Http:
             blocks = (size // self._block_size) + 1
 
             if local_token in self._downloaded_blocks:
-                remain_blocks = blocks - len(self._downloaded_blocks[local_token])
+                downloaded_blocks = self._downloaded_blocks[local_token]
+                remain_blocks = blocks - bin(int.from_bytes(downloaded_blocks, "little")).count("1")
                 del self._downloaded_blocks[local_token]
             else:
                 remain_blocks = blocks
@@ -214,25 +266,23 @@ class Http:
             if local_token in self._stream_transports:
                 del self._stream_transports[local_token]
 
+            self._filename_header_cache.pop(local_token.message_id, None)
+
         if local_token in self._stream_debounce:
             self._stream_debounce[local_token].reschedule()
 
         del _debounce
 
     async def _stream_handler(self, request: Request) -> typing.Optional[Response]:
-        _message_id: str = request.match_info["message_id"]
-
-        if not _message_id.isdigit():
-            return Response(status=401)
-
-        _token: str = request.match_info["token"]
-
-        if not _token.isdigit():
+        # error responses are built per request: aiohttp binds a Response to the request it is prepared for,
+        # so a shared instance would hand back the first request's payload writer on reuse
+        try:
+            message_id = int(request.match_info["message_id"])
+            token = int(request.match_info["token"])
+        except ValueError:
             return Response(status=401)
 
-        local_token = LocalToken(_message_id, _token)
-        del _token
-        del _message_id
+        local_token = LocalToken(message_id, token)
 
         if not self._check_local_token(local_token):
             return Response(status=403)
@@ -264,6 +314,17 @@ class Http:
             return Response(status=404)
 
         size = message.media.document.size
+        filename_header = self._get_filename_header(local_token.message_id)
+
+        if filename_header is None:
+            try:
+                filename = mtproto_filename(message)
+            except TypeError:
+                filename = f"file_{message.media.document.id}"
+
+            filename_header = f'inline; filename="{quote(filename)}"'
+            self._set_filename_header(local_token.message_id, filename_header)
+
         read_after = offset + data_to_skip
 
         if read_after > size:
@@ -277,33 +338,49 @@ class Http:
 
         status_code = 206 if (read_after or (max_size != size)) else 200
 
-        try:
-            filename = mtproto_filename(message)
-        except TypeError:
-            filename = f"file_{message.media.document.id}"
-
         logging.info("Incoming streaming request: %s %s %s", request.method, local_token, request.headers)
 
         if request.method == "HEAD":
             response = Response(status=status_code)
             self._write_http_range_headers(response, read_after, size, max_size)
-            self._write_filename_header(response, filename)
+            self._write_filename_header(response, filename_header)
             self._write_access_control_headers(response)
             return response
 
         stream = StreamResponse(status=status_code)
         self._write_http_range_headers(stream, read_after, size, max_size)
-        self._write_filename_header(stream, filename)
+        self._write_filename_header(stream, filename_header)
         self._write_access_control_headers(stream)
 
         await stream.prepare(request)
+        # a larger send buffer and corking let the kernel batch blocks into full segments
+        self._set_stream_socket_options(request.transport, cork=True)
+
+        # bind the per-block lookups to locals, the loop runs once per block
+        feed_timeout = self._feed_timeout
+        feed_stream_transport = self._feed_stream_transport
+        feed_downloaded_blocks = self._feed_downloaded_blocks
+        get_block = functools.partial(self._bot_client.get_block, message)
+        block_size = self._block_size
+        write = stream.write
+        transport = request.transport
+
+        if transport is None:  # the client disconnected during prepare()
+            return None
+
+        next_block = asyncio.create_task(get_block(offset, block_size))
 
         try:
             while offset < max_size:
-                self._feed_timeout(local_token, size)
-                block = await self._bot_client.get_block(message, offset, self._block_size)
+                feed_timeout(local_token, size)
+                # slice through a memoryview so trimming the block does not copy it
+                block = memoryview(await next_block)
                 new_offset = offset + len(block)
 
+                # fetch the next block from telegram while this one is written to the client
+                if new_offset < max_size:
+                    next_block = asyncio.create_task(get_block(new_offset, block_size))
+
                 if data_to_skip:
                     block = block[data_to_skip:]
                     data_to_skip = False
@@ -311,18 +388,19 @@ class Http:
                 if new_offset > max_size:
                     block = block[: -(new_offset - max_size)]
 
-                if request.transport is None:
-                    break
-
-                self._feed_stream_transport(local_token, request.transport)
+                feed_stream_transport(local_token, transport)
 
-                if request.transport.is_closing():
+                if transport.is_closing():
                     break
 
-                await stream.write(block)
-                self._feed_downloaded_blocks(offset, local_token)
+                await write(block)
+                feed_downloaded_blocks(offset, local_token, size)
                 offset = new_offset
 
+            self._set_stream_socket_options(transport, cork=False)
             await stream.write_eof()
         except (ConnectionResetError, BrokenPipeError, ConnectionError):
             logging.warning("Broken streaming connection: %s %s", local_token, request.headers)
+        finally:
+            # no-op once awaited, drops the prefetch when the loop exits early
+            next_block.cancel()
@@ -15,12 +15,14 @@ class LocalToken:
     def __init__(self, message_id: Union[str, int], token: Optional[Union[str, int]] = None):
         self.message_id = int(message_id)
         self.token = int(token or secret_token())
+        # tokens are used as dict keys on every stream request, compute the key once
+        self._hash = (self.message_id << 64) ^ self.token
 
     def __hash__(self):
-        return (self.message_id << 64) ^ self.token
+        return self._hash
 
     def __eq__(self, other):
-        return isinstance(other, LocalToken) and self.__hash__() == other.__hash__()
+        return isinstance(other, LocalToken) and self._hash == other._hash
 
     def __str__(self):
         return format(self.__hash__(), "x")
@@ -1,16 +1,30 @@
+import asyncio
 import html
 import logging
 import re
 import typing
 
-from pyrogram.errors import MessageNotModified
+from pyrogram.errors import FloodWait, MessageNotModified
 from pyrogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup
 
-from .button import DeviceSelectButton, PlayButton, StopButton, PauseButton, ResumeButton, RefreshButton, DeviceButton
+from .button import (
+    gen_data,
+    DeviceSelectButton,
+    PlayButton,
+    StopButton,
+    PauseButton,
+    ResumeButton,
+    RefreshButton,
+    DeviceButton,
+)
 from .client import BotClient
-from .device import Device, DeviceFinderCollection
+from .device import CAP_PAUSE, CAP_RESUME, Device, DeviceFinderCollection
 from .utils import LocalToken, NoDeviceException, ActionNotSupportedException
-from .http import Http
+from .http import AsyncDebounce, Http
+
+_DEVICE_REGEX = re.compile(r"on device ([^,]*)")
+_EDIT_DEBOUNCE_TIMEOUT = 1.0
+_NAMED_MEDIA_TYPES = ("document", "video", "audio", "video_note", "animation")
 
 
 class UserData:
@@ -29,9 +43,7 @@ class PlayingVideos:
         self._user_data: typing.Dict[int, UserData] = {}
 
     def remove(self, playing_video: "PlayingVideo"):
-        local_token = playing_video.local_token
-        if local_token in self._playing_videos:
-            del self._playing_videos[local_token]
+        self._playing_videos.pop(playing_video.local_token, None)
 
     def new_video(self, local_token: LocalToken, user_id, video_message, control_message, link_message, device=None):
         device = device or self.get_user_device(user_id)
@@ -50,8 +62,9 @@ class PlayingVideos:
         return self._http.add_remote_token(playing_video)
 
     async def reconstruct_playing_video(self, local_token: LocalToken, user_id, control_message):
-        if local_token in self._playing_videos:
-            return self._playing_videos[local_token]
+        playing_video = self._playing_videos.get(local_token)
+        if playing_video is not None:
+            return playing_video
         # re-construct PlayVideo when the bot is restarted
         video_message: Message = await self._bot_client.get_message(local_token.message_id)
         if control_message.reply_to_message_id and control_message.reply_to_message_id != local_token.message_id:
@@ -65,12 +78,13 @@ class PlayingVideos:
         return self.new_video(local_token, user_id, video_message, control_message, link_message, device=device)
 
     async def handle_closed(self, remains: float, local_token: LocalToken):
-        if local_token in self._playing_videos:
-            playing_video = self._playing_videos[local_token]
-            device = playing_video.playing_device
-            await playing_video.send_stopped_control_message(remaining=remains)
-            del self._playing_videos[local_token]
-            await device.on_close(local_token)
+        playing_video = self._playing_videos.pop(local_token, None)
+        if playing_video is None:
+            return
+
+        device = playing_video.playing_device
+        await playing_video.send_stopped_control_message(remaining=remains)
+        await device.on_close(local_token)
 
     def get_user_device(self, user_id):
         user_data = self._user_data.get(user_id)
@@ -103,66 +117,125 @@ class PlayingVideo:
         self.control_message = control_message
         self.link_message = link_message
         self.playing_videos = playing_videos
+        self._device_str_cache: typing.Optional[str] = None
+        self._message_str_cache: typing.Optional[str] = None
+        self._markup_cache: typing.Dict[str, InlineKeyboardMarkup] = {}
+        self._data_prefix_cache: typing.Dict[str, str] = {}
+        self._edit_debounce: typing.Optional[AsyncDebounce] = None
+        self._edit_lock = asyncio.Lock()
+        self._requested_render_hash = 0
+        self._last_render_hash = 0
 
     def _gen_device_str(self):
-        return (
-            f"on device <code>"
-            f"{html.escape(self.playing_device.get_device_name()) if self.playing_device else 'NONE'}</code>"
-        )
+        if self._device_str_cache is None:
+            self._device_str_cache = (
+                f"on device <code>"
+                f"{html.escape(self.playing_device.get_device_name()) if self.playing_device else 'NONE'}</code>"
+            )
+        return self._device_str_cache
 
     @classmethod
     def parse_device_str(cls, text):
-        groups = re.search("on device ([^,]*)", text)
-        if not groups:
-            return None
-        return groups.group(1)
+        return m.group(1) if (m := _DEVICE_REGEX.search(text)) else None
 
     def _gen_message_str(self):
-        return f"for file <code>{self.video_message.id}</code>"
+        if self._message_str_cache is None:
+            self._message_str_cache = f"for file <code>{self.video_message.id}</code>"
+        return self._message_str_cache
+
+    def data_prefix(self, prefix: str) -> str:
+        data_prefix = self._data_prefix_cache.get(prefix)
+        if data_prefix is None:
+            data_prefix = self._data_prefix_cache[prefix] = gen_data(prefix, self.local_token, "")
+        return data_prefix
 
     def _gen_device_button(self, device):
-        return InlineKeyboardButton(repr(device), f"s:{self.local_token}:{repr(device)}")
+        device_name = repr(device)
+        return InlineKeyboardButton(device_name, self.data_prefix(DeviceSelectButton.PREFIX) + device_name)
+
+    def _get_markup(self, state: str, button_factories) -> InlineKeyboardMarkup:
+        # local_token is immutable and the button sets are static, so each markup only needs to be built once
+        markup = self._markup_cache.get(state)
+        if markup is None:
+            markup = InlineKeyboardMarkup([[factory(self).get_button()] for factory in button_factories])
+            self._markup_cache[state] = markup
+        return markup
+
+    def _stopped_markup(self) -> InlineKeyboardMarkup:
+        return self._get_markup("stopped", (DeviceButton, PlayButton))
+
+    def _playing_markup(self) -> InlineKeyboardMarkup:
+        return self._get_markup("playing", (StopButton, PauseButton))
+
+    def _paused_markup(self) -> InlineKeyboardMarkup:
+        return self._get_markup("paused", (StopButton, ResumeButton))
 
     async def send_stopped_control_message(self, remaining=None):
-        buttons = [
-            [DeviceButton(self).get_button()],
-            [PlayButton(self).get_button()],
-        ]
         if not remaining:
             text = f"Controller {self._gen_message_str()} {self._gen_device_str()}"
         else:
             text = f"Streaming closed {self._gen_message_str()} {self._gen_device_str()}, {remaining:0.2f}% remains"
-        await self.create_or_update_control_message(text, buttons)
+        await self.create_or_update_control_message(text, self._stopped_markup())
 
     async def send_playing_control_message(self):
-        buttons = [
-            [StopButton(self).get_button()],
-            [PauseButton(self).get_button()],
-        ]
         text = f"Playing {self._gen_message_str()} {self._gen_device_str()}"
-        await self.create_or_update_control_message(text, buttons)
+        await self.create_or_update_control_message(text, self._playing_markup())
 
     async def send_paused_control_message(self):
-        buttons = [
-            [StopButton(self).get_button()],
-            [ResumeButton(self).get_button()],
-        ]
         text = f"Paused {self._gen_message_str()} {self._gen_device_str()}"
-        await self.create_or_update_control_message(text, buttons)
+        await self.create_or_update_control_message(text, self._paused_markup())
 
     async def send_select_device_message(self, devices):
         device_buttons = [[DeviceSelectButton(repr(d), self).get_button()] for d in devices]
         refresh_button = [[RefreshButton(self).get_button()]]
-        await self.create_or_update_control_message("Select a device", device_buttons + refresh_button)
+        markup = InlineKeyboardMarkup(device_buttons + refresh_button)
+        await self.create_or_update_control_message("Select a device", markup)
+
+    async def create_or_update_control_message(self, text, markup: InlineKeyboardMarkup):
+        render_hash = hash((text, tuple((b.text, b.callback_data) for row in markup.inline_keyboard for b in row)))
+        if render_hash == self._requested_render_hash == self._last_render_hash:
+            # telegram already shows this rendering and nothing newer is queued, it would answer MessageNotModified
+            return
+        self._requested_render_hash = render_hash
 
-    async def create_or_update_control_message(self, text, buttons):
         if self.control_message:
+            # coalesce rapid state changes into a single edit to avoid Telegram flood waits.
+            # this is a trailing debounce: every update restarts the delay, only the latest rendering is sent
+            if self._edit_debounce is None or not self._edit_debounce.update_args(text, markup, render_hash):
+                self._schedule_edit(text, markup, render_hash, _EDIT_DEBOUNCE_TIMEOUT)
+        else:
+            assert self.video_message is not None
+            self.control_message = await self.video_message.reply(text, reply_markup=markup)
+            self._last_render_hash = render_hash
+
+    def _schedule_edit(self, text, markup: InlineKeyboardMarkup, render_hash: int, timeout: float):
+        self._edit_debounce = AsyncDebounce(self._edit_control_message, timeout)
+        self._edit_debounce.update_args(text, markup, render_hash)
+
+    async def _edit_control_message(self, text, markup: InlineKeyboardMarkup, render_hash: int):
+        # the debounce has stopped sleeping, newer state changes must schedule a new edit instead of cancelling this one
+        self._edit_debounce = None
+        assert self.control_message is not None
+
+        # edits are sent one at a time so an older rendering can never land after a newer one
+        async with self._edit_lock:
+            if render_hash != self._requested_render_hash:
+                # superseded while waiting, the newer edit is already scheduled
+                return
+
             try:
-                await self.control_message.edit_text(text, reply_markup=InlineKeyboardMarkup(buttons))
+                await self.control_message.edit_text(text, reply_markup=markup)
+                self._last_render_hash = render_hash
             except MessageNotModified:
-                pass
-        else:
-            self.control_message = await self.video_message.reply(text, reply_markup=InlineKeyboardMarkup(buttons))
+                self._last_render_hash = render_hash
+            except FloodWait as error:
+                self._last_render_hash = 0
+                logging.warning("Flood wait of %ss when editing control message", error.value)
+                if self._edit_debounce is None:  # a newer pending edit supersedes this one
+                    self._schedule_edit(text, markup, render_hash, _EDIT_DEBOUNCE_TIMEOUT + error.value)
+            except Exception:
+                self._last_render_hash = 0
+                logging.exception("Failed to edit control message")
 
     async def play(self):
         if not self.playing_device:
@@ -194,18 +267,18 @@ class PlayingVideo:
     async def pause(self):
         if not self.playing_device:
             raise NoDeviceException
-        if hasattr(self.playing_device, "pause"):
-            await self.playing_device.pause()
-            return await self.send_paused_control_message()
-        raise ActionNotSupportedException
+        if not self.playing_device.capabilities & CAP_PAUSE:
+            raise ActionNotSupportedException
+        await self.playing_device.pause()
+        return await self.send_paused_control_message()
 
     async def resume(self):
         if not self.playing_device:
             raise NoDeviceException
-        if hasattr(self.playing_device, "resume"):
-            await self.playing_device.resume()
-            return await self.send_playing_control_message()
-        raise ActionNotSupportedException
+        if not self.playing_device.capabilities & CAP_RESUME:
+            raise ActionNotSupportedException
+        await self.playing_device.resume()
+        return await self.send_playing_control_message()
 
     async def close(self, remains):
         device = self.playing_device
@@ -215,15 +288,14 @@ class PlayingVideo:
 
     async def select_device(self, device: Device):
         self.playing_device = device
+        self._device_str_cache = None
         self.playing_videos.set_user_device(self.user_id, device)
         await self.send_stopped_control_message()
 
     @staticmethod
     def pyrogram_filename(message: Message) -> str:
-        named_media_types = ("document", "video", "audio", "video_note", "animation")
-        try:
-            return next(
-                getattr(message, t, None).file_name for t in named_media_types if getattr(message, t, None) is not None
-            )
-        except StopIteration as error:
-            raise TypeError() from error
+        for media_type in _NAMED_MEDIA_TYPES:
+            media = getattr(message, media_type, None)
+            if media is not None:
+                return media.file_name
+        raise TypeError()